@@ -3,3 +3,6 @@ SERVER_PORT=8000
 CHUNK_SIZE=20*1024
 MSG_TYPE_SIZE=10
 MAX_THREADS_COUNT=4
+MSG_LENGTH_SIZE=4
+MAX_MSG_SIZE=64*1024*1024
+MAX_PING_THREADS_COUNT=8
@@ -6,11 +6,23 @@ import socket
 import sys
 import threading
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep
 from tqdm import tqdm
-from config import MAX_THREADS_COUNT, MSG_TYPE_SIZE, CHUNK_SIZE, SERVER_PORT, SERVER_ADDRESS
+from config import MAX_THREADS_COUNT, MAX_PING_THREADS_COUNT, MSG_TYPE_SIZE, CHUNK_SIZE, SERVER_PORT, SERVER_ADDRESS
+from protocol import send_msg, send_msg_header, recv_msg, recv_msg_into
 
 peers_semaphore = threading.BoundedSemaphore(MAX_THREADS_COUNT)
+# Number of peer connections being handled, reported as this seeder's load
+active_handlers = 0
+active_handlers_lock = threading.Lock()
+
+# Prefer OpenSSL's SHA-1 (uses SHA-NI when the CPU has it), else CPython's builtin one
+try:
+    from _hashlib import openssl_sha1 as _SHA1
+except ImportError:
+    _SHA1 = hashlib.sha1
 
 def print_help():
     print("""
@@ -107,63 +119,72 @@ def is_port_available(port_number: int) -> bool:
     finally:
         s.close()
 
-def choose_peer(peers: list[(str, int)]) -> (str, int):
-    active_peers: dict[(str,int), int] = dict()
-    for peer in peers:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(10)
-            s.connect(peer)
-            s.sendall(f"PPQ_PPING".encode())
-            data = s.recv(MSG_TYPE_SIZE + CHUNK_SIZE)
-            if not data and data[MSG_TYPE_SIZE:] != b"PPS_PPONG":
-                raise ConnectionError
-            active_peers[peer] = data.decode()[MSG_TYPE_SIZE:]
-        except (ConnectionError, TimeoutError):
-            continue
-        finally:
-            s.settimeout(None)
-            s.close()
-    return min(active_peers, key=lambda k: active_peers[k], default=None)
-
-def chunk_file(file_path: str) -> list[bytes]:
-    chunks: list[bytes] = []
-
-    with open(file_path, "rb") as f:
-        while True:
-            chunk: bytes = f.read(CHUNK_SIZE)
-            if not chunk:
-                break
+class DownloadAborted(Exception):
+    def __init__(self, msg: str, exit_code: int, dead_peers: str = ""):
+        super().__init__(msg)
+        self.exit_code = exit_code
+        self.dead_peers = dead_peers
 
-            chunks.append(chunk)
+def ping_peer(peer: (str, int)) -> int | None:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.settimeout(10)
+        s.connect(peer)
+        send_msg(s, f"PPQ_PPING".encode())
+        data = recv_msg(s)
+        if data[:MSG_TYPE_SIZE] != b"PPS_PPONG ":
+            raise ConnectionError
+        return int(data[MSG_TYPE_SIZE:])
+    except (OSError, ValueError):
+        # Unreachable, unresolvable or misbehaving peers are skipped
+        return None
+    finally:
+        s.close()
 
-    return chunks
+def choose_peer(peers: list[(str, int)]) -> (str, int):
+    if not peers:
+        return None
 
-def hash_chunks(chunks: list[bytes]) -> list[str]:
-    chunk_hashes: list[str] = []
+    # Probe peers concurrently so a dead one only costs a single timeout
+    with ThreadPoolExecutor(max_workers=min(len(peers), MAX_PING_THREADS_COUNT)) as executor:
+        loads = dict(zip(peers, executor.map(ping_peer, peers)))
 
-    for chunk in chunks:
-        chunk_hash = hashlib.sha1(chunk).hexdigest()
-        chunk_hashes.append(chunk_hash)
+    active_peers: dict[(str,int), int] = { peer: load for peer, load in loads.items() if load is not None }
+    return min(active_peers, key=active_peers.get, default=None)
 
-    return chunk_hashes
+def sha1_hex(buf: bytes | memoryview) -> str:
+    return _SHA1(buf, usedforsecurity=False).hexdigest()
 
-def save_chunks(chunks: list[bytes], chunk_hashes: list[str], chunks_dir: str):
-    if not os.path.exists(chunks_dir):
-        os.mkdir(chunks_dir)
+def save_chunk(chunk: bytes, chunks_dir: str) -> str:
+    chunk_hash = sha1_hex(chunk)
+    with open(f"{chunks_dir}/{chunk_hash}", "wb") as f:
+        f.write(chunk)
+    return chunk_hash
 
-    for chunk, chunk_hash in zip(chunks, chunk_hashes):
-        with open(f"{chunks_dir}/{chunk_hash}", "wb") as f:
-            f.write(chunk)
-        chunks.append(chunk_hash)
+def process_file(file_path: str, chunks_dir: str) -> list[str]:
+    chunk_hashes: list[str] = []
+    window = os.cpu_count() or 1
+
+    # Hash and save chunks in parallel (hashlib releases the GIL) while reading the file,
+    # keeping at most `window` chunks in flight so memory stays bounded
+    with open(file_path, "rb", buffering=0) as f, ThreadPoolExecutor(max_workers=window) as executor:
+        pending: deque = deque()
+        while chunk := f.read(CHUNK_SIZE):
+            pending.append(executor.submit(save_chunk, chunk, chunks_dir))
+            if len(pending) >= window:
+                chunk_hashes.append(pending.popleft().result())
+        chunk_hashes.extend(future.result() for future in pending)
 
-def send_ppq_msg(s: socket.socket, msg: str) -> bytes:
-    s.sendall(msg.encode())
-    data = s.recv(MSG_TYPE_SIZE + CHUNK_SIZE)
+    return chunk_hashes
+
+def send_ppq_msg(s: socket.socket, msg: str, buf: bytearray | None = None) -> bytes | memoryview:
+    send_msg(s, msg.encode())
+    data = recv_msg(s) if buf is None else recv_msg_into(s, buf)
     s.close()
 
     if data[:MSG_TYPE_SIZE] == b"PPS_ERROR ":
-        print(f"Error from server: {data[MSG_TYPE_SIZE:]}")
+        print(f"Error from server: {bytes(data[MSG_TYPE_SIZE:]).decode()}")
         sys.exit(5)
 
     return data[MSG_TYPE_SIZE:]
@@ -179,12 +200,12 @@ def send_csq_msg(msg: str) -> str:
         print(f"Connection error: {e}")
         sys.exit(1)
 
-    s.send(msg.encode())
-    data = s.recv(MSG_TYPE_SIZE + CHUNK_SIZE)
+    send_msg(s, msg.encode())
+    data = recv_msg(s)
     s.close()
 
     if data[:MSG_TYPE_SIZE] == b"CSS_ERROR ":
-        print(f"Error from server: {data[MSG_TYPE_SIZE:]}")
+        print(f"Error from server: {data[MSG_TYPE_SIZE:].decode()}")
         sys.exit(5)
 
     return data[MSG_TYPE_SIZE:].decode()
@@ -208,18 +229,16 @@ def deannounce_peers(peers: str):
     send_csq_msg(f"CSQ_URGPR {peers}")
 
 def upload_file(user_identification: str, file_path: str):
-    # Split file into chunks
-    chunks = chunk_file(file_path)
-    chunk_hashes = hash_chunks(chunks)
-
-    # Register the file within the server
-    _, file_name = os.path.split(file_path)
-    ok = send_csq_msg(f"CSQ_REGFI {file_name} {' '.join(chunk_hashes)}")
-
     chunks_dir = f"chunks/{user_identification}"
     if not os.path.exists(chunks_dir):
         os.mkdir(chunks_dir)
-    save_chunks(chunks, chunk_hashes, chunks_dir) # TODO! - Retransmit before saving if ok(data) number != len(chunks)
+
+    # Split file into chunks, saving them as they are hashed
+    chunk_hashes = process_file(file_path, chunks_dir)
+
+    # Register the file within the server
+    _, file_name = os.path.split(file_path)
+    ok = send_csq_msg(f"CSQ_REGFI {file_name} {' '.join(chunk_hashes)}") # TODO! - Retransmit if ok(data) number != len(chunks)
 
     if int(ok) != len(chunk_hashes):
         print("Failed uploading file. Upload incomplete.")
@@ -233,75 +252,111 @@ def download_file(user_identification: str, file_name: str):
     data = send_csq_msg(f"CSQ_GETFI {file_name}")
     chunk_hashes = data.split()
 
-    file_chunks: dict[str, bytes] = { chunk_hash: None for chunk_hash in chunk_hashes }
-    semaphore = threading.BoundedSemaphore(MAX_THREADS_COUNT)
-    chunk_threads = []
+    # A chunk may repeat within a file, so keep every offset it is written to
+    chunk_offsets: dict[str, list[int]] = dict()
+    for i, chunk_hash in enumerate(chunk_hashes):
+        chunk_offsets.setdefault(chunk_hash, []).append(i * CHUNK_SIZE)
+    chunk_sizes: dict[str, int] = dict()
+    # Each worker thread receives its chunks into its own reusable buffer
+    worker_buffers = threading.local()
+    # Set on the first failed chunk so workers that already started skip their chunk
+    aborted = threading.Event()
+
+    def fetch_chunk(user_identification: str, chunk_hash: str, chunk_peers: list[str]):
+        if aborted.is_set():
+            return
+
+        peers = [(peer.split(":")[0], int(peer.split(":")[1])) for peer in chunk_peers]
+        peer = choose_peer(peers)
+        if peer is None:
+            raise DownloadAborted("No active peers seeding.", 0, " ".join(chunk_peers))
 
-    def handle_chunk(user_identification: str, chunk_hash: str, peer: (str, int)):
-        semaphore.acquire()
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(peer)
 
-        data = send_ppq_msg(s, f"PPQ_GETCK {chunk_hash}")
+        if not hasattr(worker_buffers, "buf"):
+            worker_buffers.buf = bytearray(MSG_TYPE_SIZE + CHUNK_SIZE)
+        data = send_ppq_msg(s, f"PPQ_GETCK {chunk_hash}", worker_buffers.buf)
+
+        if chunk_hash != sha1_hex(data):
+            raise DownloadAborted("Integrity check failed. Download compromised.", 1)
+
+        for offset in chunk_offsets[chunk_hash]:
+            os.pwrite(fd, data, offset)
+        chunk_sizes[chunk_hash] = len(data)
 
-        if chunk_hash in file_chunks.keys():
-            file_chunks[chunk_hash] = data
-            if not os.path.exists(f"chunks/{user_identification}"):
-                os.mkdir(f"chunks/{user_identification}")
-            with open(f"chunks/{user_identification}/{chunk_hash}", "wb") as f:
-                f.write(data)
-        semaphore.release()
+        with open(f"{chunks_dir}/{chunk_hash}", "wb") as f:
+            f.write(data)
 
     if not chunk_hashes:
         print("File not available.")
         sys.exit(0)
 
-    # Request peers for each chunk
-    for chunk_hash in tqdm(chunk_hashes):
-        data = send_csq_msg(f"CSQ_GETCK {chunk_hash}")
-
-        if not data:
-            print("No active peers seeding.")
-            sys.exit(0)
-
-        peers = [(peer.split(":")[0], int(peer.split(":")[1])) for peer in data.split()]
-        peer = choose_peer(peers)
-        if peer is None:
-            deannounce_peers(" ".join(data))
-            print("No active peers seeding.")
-            sys.exit(0)
+    # Request peers for every chunk at once, one "<chunk_hash> <peer> ..." line per chunk
+    data = send_csq_msg(f"CSQ_GETCS {' '.join(chunk_offsets)}")
+    chunks_peers: dict[str, list[str]] = dict()
+    for line in data.splitlines():
+        chunk_hash, *chunk_peers = line.split()
+        chunks_peers[chunk_hash] = chunk_peers
 
-        chunk_thread = threading.Thread(
-            target=handle_chunk,
-            args=(user_identification, chunk_hash, peer)
-        )
-        chunk_thread.start()
-        chunk_threads.append(chunk_thread)
-        
-        # sleep(0.01)
-
-    for thread in chunk_threads:
-        thread.join()
-    
-    if None in file_chunks.values():
-        print("Missing some chunks, download incomplete")
-        sys.exit(1)
+    if not all(chunks_peers.get(chunk_hash) for chunk_hash in chunk_offsets):
+        print("No active peers seeding.")
+        sys.exit(0)
 
     downloads_dir = f"downloads/{user_identification}"
     if not os.path.exists(downloads_dir):
         os.mkdir(downloads_dir)
-    for chunk_hash, chunk in file_chunks.items():
 
-        if chunk_hash != hashlib.sha1(chunk).hexdigest():
-            print("Integrity check failed. Download compromised.")
+    # Created once here rather than checked by every worker
+    chunks_dir = f"chunks/{user_identification}"
+    os.makedirs(chunks_dir, exist_ok=True)
+
+    # Workers write their chunks straight into place in a preallocated temporary file,
+    # which only replaces the download once every chunk has arrived
+    file_path = f"{downloads_dir}/{file_name}"
+    part_path = f"{file_path}.part"
+    fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, len(chunk_hashes) * CHUNK_SIZE)
+
+        with ThreadPoolExecutor(max_workers=MAX_THREADS_COUNT) as executor:
+            futures = [
+                executor.submit(fetch_chunk, user_identification, chunk_hash, chunks_peers[chunk_hash])
+                for chunk_hash in chunk_offsets
+            ]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    future.result()
+                except BaseException as e:
+                    # A failed chunk aborts the download, drop the queued ones and report it once
+                    aborted.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    if not isinstance(e, DownloadAborted):
+                        raise
+                    if e.dead_peers:
+                        deannounce_peers(e.dead_peers)
+                    print(e)
+                    sys.exit(e.exit_code)
+
+        if len(chunk_sizes) != len(chunk_offsets):
+            print("Missing some chunks, download incomplete")
             sys.exit(1)
 
-        with open(f"{downloads_dir}/{file_name}", "ab") as f:
-            f.write(chunk)
+        # Only the last chunk may be shorter than CHUNK_SIZE
+        os.ftruncate(fd, (len(chunk_hashes) - 1) * CHUNK_SIZE + chunk_sizes[chunk_hashes[-1]])
+    except BaseException:
+        os.close(fd)
+        os.unlink(part_path)
+        raise
+    os.close(fd)
+    os.replace(part_path, file_path)
 
 def handle_peer(user_identification: str, peer_socket: socket.socket, peer_addr: (str, int)):
-    peers_semaphore.acquire()
-    data = peer_socket.recv(MSG_TYPE_SIZE + CHUNK_SIZE).decode()
+    try:
+        # Peer requests are short, anything bigger than a chunk message is refused
+        data = recv_msg(peer_socket, MSG_TYPE_SIZE + CHUNK_SIZE).decode()
+    except ConnectionError:
+        data = ""
     if not data:
        return 
     print(f"Received message: {data}")
@@ -309,8 +364,8 @@ def handle_peer(user_identification: str, peer_socket: socket.socket, peer_addr:
     match req_type:
 
         case "PPQ_PPING":
-            msg = f"PPS_PPONG {threading.active_count() - 1}"
-            peer_socket.sendall(msg.encode())
+            msg = f"PPS_PPONG {active_handlers}"
+            send_msg(peer_socket, msg.encode())
             print(f"Message sent: {msg}")
 
         case "PPQ_GETCK":
@@ -319,27 +374,71 @@ def handle_peer(user_identification: str, peer_socket: socket.socket, peer_addr:
             chunk_dir = f"chunks/{user_identification}/{chunk_hash}"
             if not os.path.exists(chunk_dir):
                 msg = "PPS_ERROR Chunk unavailable on requested peer."
-                peer_socket.sendall(msg.encode())
+                send_msg(peer_socket, msg.encode())
                 peer_socket.close()
                 print("You dont hold the requested chunk [TODO].")
                 print_help()
                 sys.exit(0)
 
+            # Let the kernel copy the chunk file straight into the socket
             with open(chunk_dir, "rb") as f:
-                chunk = f.read()
-            msg = b"PPS_GETCK " + chunk
-            peer_socket.send(msg)
+                send_msg_header(peer_socket, b"PPS_GETCK ", MSG_TYPE_SIZE + os.fstat(f.fileno()).st_size)
+                peer_socket.sendfile(f)
             print(f"Message sent. [data from {chunk_hash}]")
 
         case _:
             msg = f"CSS_ERROR Unknown request type '{req_type}'."
-            peer_socket.sendall(msg.encode())
+            send_msg(peer_socket, msg.encode())
             print(f"Message sent: {msg}")
             peer_socket.close()
 
     peer_socket.close()
-    peers_semaphore.release()
-    
+
+def serve_peer(user_identification: str, peer_socket: socket.socket, peer_addr: (str, int)):
+    global active_handlers
+
+    # The accept loop acquires peers_semaphore for each accepted connection
+    with active_handlers_lock:
+        active_handlers += 1
+    try:
+        handle_peer(user_identification, peer_socket, peer_addr)
+    finally:
+        with active_handlers_lock:
+            active_handlers -= 1
+        peer_socket.close()
+        peers_semaphore.release()
+
+def open_seed_sockets(port_number: int) -> list[socket.socket]:
+    # With SO_REUSEPORT Linux spreads incoming connections across several listening sockets,
+    # other systems accept the option but don't balance accept() between them
+    reuseport = sys.platform.startswith("linux") and hasattr(socket, "SO_REUSEPORT")
+    count = (os.cpu_count() or 1) if reuseport else 1
+    sockets: list[socket.socket] = []
+    for _ in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if count > 1:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(('', port_number))
+        s.listen()
+        # Port 0 picks a free port on the first bind, the other sockets share it
+        port_number = s.getsockname()[1]
+        sockets.append(s)
+    return sockets
+
+def accept_peers(user_identification: str, s: socket.socket):
+    while True:
+        peer_socket, peer_addr = s.accept()
+        print(f"New connection from {peer_addr}")
+        # Block until a handler slot is free instead of spinning. Taken after accept()
+        # so idle accept loops don't hold slots that a busy socket could use.
+        peers_semaphore.acquire()
+        peer_thread = threading.Thread(
+            target=serve_peer,
+            args=(user_identification, peer_socket, peer_addr),
+            daemon=True
+        )
+        peer_thread.start()
+
 if __name__ == "__main__":
 
     user_identification, cmd, cmd_args = parse_args()
@@ -384,32 +483,26 @@ if __name__ == "__main__":
 
         case "seed":
             [port_number] = cmd_args
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind(('', port_number))
-            s.listen()
+            sockets = open_seed_sockets(port_number)
+            s = sockets[0]
             print(f"Seeding on {s.getsockname()[0]}:{s.getsockname()[1]}.")
             announce_chunks(user_identification, s.getsockname()[0], s.getsockname()[1])
-            while True:
-                try:
-                    if threading.active_count() >= MAX_THREADS_COUNT:
-                        continue
-                    peer_socket, peer_addr = s.accept()
-                    print(f"New connection from {peer_addr}")
-                    peer_thread = threading.Thread(
-                        target=handle_peer,
-                        args=(user_identification, peer_socket, peer_addr),
-                        daemon=True
-                    )
-                    peer_thread.start()
-                except KeyboardInterrupt:
-                    print("Closing...")
-                    break
-                except Exception as e:
-                    print(f"Conection error: {e}")
-                    break
+            for extra_socket in sockets[1:]:
+                threading.Thread(
+                    target=accept_peers,
+                    args=(user_identification, extra_socket),
+                    daemon=True
+                ).start()
+            try:
+                accept_peers(user_identification, s)
+            except KeyboardInterrupt:
+                print("Closing...")
+            except Exception as e:
+                print(f"Conection error: {e}")
 
             deannounce_peers(f"{s.getsockname()[0]}:{s.getsockname()[1]}")
-            s.close()
+            for seed_socket in sockets:
+                seed_socket.close()
             sys.exit(0)
 
         case _:
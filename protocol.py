@@ -0,0 +1,50 @@
+import asyncio
+import socket
+from config import MSG_LENGTH_SIZE, MAX_MSG_SIZE
+
+def send_msg(s: socket.socket, payload: bytes):
+    # Every message is prefixed with its length so the receiver knows when it is complete
+    s.sendall(len(payload).to_bytes(MSG_LENGTH_SIZE, "big") + payload)
+
+def send_msg_header(s: socket.socket, header: bytes, length: int):
+    # Sends the prefix and header of a message whose body the caller sends afterwards
+    s.sendall(length.to_bytes(MSG_LENGTH_SIZE, "big") + header)
+
+def recvall_into(s: socket.socket, mv: memoryview):
+    received = 0
+    while received < len(mv):
+        count = s.recv_into(mv[received:])
+        if not count:
+            raise ConnectionError("Connection closed before the message was complete.")
+        received += count
+
+def recvall(s: socket.socket, n: int) -> bytearray:
+    buf = bytearray(n)
+    recvall_into(s, memoryview(buf))
+    return buf
+
+def parse_length(length_prefix: bytes, max_length: int) -> int:
+    # The prefix comes from the network, so check it before allocating anything for the body
+    length = int.from_bytes(length_prefix, "big")
+    if length > max_length:
+        raise ConnectionError(f"Message of {length} bytes exceeds the {max_length} bytes limit.")
+    return length
+
+def recv_msg(s: socket.socket, max_length: int = MAX_MSG_SIZE) -> bytearray:
+    length = parse_length(recvall(s, MSG_LENGTH_SIZE), max_length)
+    return recvall(s, length)
+
+def recv_msg_into(s: socket.socket, buf: bytearray) -> memoryview:
+    # Reuses the caller's buffer, the returned view is only valid until the next call
+    length = parse_length(recvall(s, MSG_LENGTH_SIZE), len(buf))
+    mv = memoryview(buf)[:length]
+    recvall_into(s, mv)
+    return mv
+
+async def write_msg(writer: asyncio.StreamWriter, payload: bytes):
+    writer.write(len(payload).to_bytes(MSG_LENGTH_SIZE, "big") + payload)
+    await writer.drain()
+
+async def read_msg(reader: asyncio.StreamReader, max_length: int = MAX_MSG_SIZE) -> bytes:
+    length = parse_length(await reader.readexactly(MSG_LENGTH_SIZE), max_length)
+    return await reader.readexactly(length)
@@ -1,126 +1,175 @@
-import json
-import socket
+import asyncio
 import sys
-import os
-from config import SERVER_ADDRESS, SERVER_PORT, CHUNK_SIZE, MSG_TYPE_SIZE
+from config import SERVER_ADDRESS, SERVER_PORT, MSG_TYPE_SIZE
+from protocol import write_msg, read_msg
 
 files: dict[str, list[str]] = dict()
 chunks: dict[str, set[str]] = dict()
+chunk_files: dict[str, set[str]] = dict()
+peer_to_chunks: dict[str, set[str]] = dict()
+file_sizes: dict[str, int] = dict()
+file_peers: dict[str, dict[str, int]] = dict()
+file_available_count: dict[str, int] = dict()
+# Encoded CSS_GETAF reply, dropped whenever a request changes files or peers
+af_cache: bytes | None = None
+
+def add_chunk_peer(chunk: str, peer: str) -> bool:
+    if peer in chunks[chunk]:
+        return False
+    chunks[chunk].add(peer)
+    peer_to_chunks.setdefault(peer, set()).add(chunk)
+    for file_name in chunk_files.get(chunk, ()):
+        held = file_peers[file_name].get(peer, 0) + 1
+        file_peers[file_name][peer] = held
+        if held == file_sizes[file_name]:
+            file_available_count[file_name] += 1
+    return True
+
+def remove_chunk_peer(chunk: str, peer: str) -> bool:
+    if peer not in chunks[chunk]:
+        return False
+    chunks[chunk].remove(peer)
+    peer_to_chunks[peer].remove(chunk)
+    if not peer_to_chunks[peer]:
+        del peer_to_chunks[peer]
+    for file_name in chunk_files.get(chunk, ()):
+        held = file_peers[file_name][peer]
+        if held == file_sizes[file_name]:
+            file_available_count[file_name] -= 1
+        if held == 1:
+            del file_peers[file_name][peer]
+        else:
+            file_peers[file_name][peer] = held - 1
+    return True
+
+def register_file(file_name: str, file_chunks: list[str]):
+    for chunk in set(files.get(file_name, [])):
+        chunk_files[chunk].discard(file_name)
+
+    # Registering a file resets the peers of its chunks
+    for chunk in file_chunks:
+        for peer in list(chunks.get(chunk, ())):
+            remove_chunk_peer(chunk, peer)
+        chunks[chunk] = set()
+
+    files[file_name] = file_chunks
+    file_sizes[file_name] = len(set(file_chunks))
+    file_peers[file_name] = dict()
+    file_available_count[file_name] = 0
+    for chunk in file_chunks:
+        chunk_files.setdefault(chunk, set()).add(file_name)
 
 def get_files():
-    msg = ""
-    for file_name, chunk_hashes in files.items():
-        msg += f"{file_name} "
-        if not chunk_hashes:
-            msg += "[0] "
-            continue
-        peer_sets = [set(chunks.get(chunk, [])) for chunk in chunk_hashes]
-        common_peers = set.intersection(*peer_sets) if peer_sets else set()
-        msg += f"[{len(common_peers)}] "
-    return msg[:-1]
+    # Number of peers holding every chunk of each file, kept up to date on each mutation
+    return " ".join(f"{file_name} [{file_available_count[file_name]}]" for file_name in files)
 
-if __name__ == "__main__":
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def handle_request(data: str) -> bytes:
+    global af_cache
+
+    req_type = data[:MSG_TYPE_SIZE-1]
+    match req_type:
+
+        case "CSQ_GETAF":
+            if af_cache is None:
+                af_cache = f"CSS_GETAF {get_files()}".encode()
+            return af_cache
+
+        case "CSQ_GETFI":
+            file_name = data[MSG_TYPE_SIZE:]
+            msg = f"CSS_GETFI {' '.join(files.get(file_name, ''))}"
+
+        case "CSQ_GETCK":
+            chunk_hash = data[MSG_TYPE_SIZE:]
+            msg = f"CSS_GETCK {' '.join(chunks.get(chunk_hash, ''))}"
+
+        case "CSQ_GETCS":
+            # Batched CSQ_GETCK, one "<chunk_hash> <peer> ..." line per requested chunk
+            chunk_hashes = data[MSG_TYPE_SIZE:].split()
+            lines = [f"{chunk_hash} {' '.join(chunks.get(chunk_hash, ''))}" for chunk_hash in chunk_hashes]
+            msg = "CSS_GETCS " + "\n".join(lines)
+
+        case "CSQ_REGFI":
+            af_cache = None
+            data = data[MSG_TYPE_SIZE:].split()
+            file_name = data[0]
+            # Interned so every file, chunk and peer index shares one object per hash
+            file_chunks = [sys.intern(chunk_hash) for chunk_hash in data[1:]]
+            register_file(file_name, file_chunks)
+            msg = f"CSS_REGFI {len(file_chunks)}"
+
+        case "CSQ_REGCK":
+            af_cache = None
+            count = 0
+            data = data[MSG_TYPE_SIZE:].split()
+            peer = sys.intern(data[0])
+            chunk_hashes = [sys.intern(chunk_hash) for chunk_hash in data[1:]]
+            for chunk in chunk_hashes:
+                if chunk in chunks:
+                    add_chunk_peer(chunk, peer)
+                    count += 1
+            msg = f"CSS_REGCK {count}"
 
+        case "CSQ_URGPR":
+            af_cache = None
+            peers = data[MSG_TYPE_SIZE:].split()
+            for peer in peers:
+                for chunk in list(peer_to_chunks.get(peer, ())):
+                    remove_chunk_peer(chunk, peer)
+            msg = "CSS_URGPR"
+
+        case "CSQ_URGCK":
+            af_cache = None
+            count = 0
+            data = data[MSG_TYPE_SIZE:].split()
+            peer = data[0]
+            chunk_hashes = data[1:]
+            for chunk in chunk_hashes:
+                if chunk in chunks:
+                    if remove_chunk_peer(chunk, peer):
+                        count += 1
+            msg = f"CSS_URGCK {count}"
+
+        case _:
+            msg = f"CSS_ERROR Unknown request type '{req_type}'."
+
+    return msg.encode()
+
+async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    client_addr = writer.get_extra_info("peername")
+    print(f"New connection from {client_addr}")
     try:
-        s.bind((SERVER_ADDRESS, SERVER_PORT))
-        s.listen()
+        data = (await read_msg(reader)).decode()
+        print(f"Received message: {data}")
+
+        # Requests only touch in-memory state and never await, so they need no locking
+        msg = handle_request(data)
+        await write_msg(writer, msg)
+        print(f"Message sent: {msg.decode()}")
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    except Exception as e:
+        print(f"Error handling connection: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        print(f"Connection closed with {client_addr}")
+
+async def serve():
+    try:
+        server = await asyncio.start_server(handle_client, SERVER_ADDRESS, SERVER_PORT)
         print(f"Listening on {SERVER_ADDRESS}:{SERVER_PORT}")
     except Exception as e:
         print(f"Failed to start server: {e}")
         sys.exit(1)
 
-    while True:
-        try:
-            client_socket, client_addr = s.accept()
-            print(f"New connection from {client_addr}")
-
-            data = client_socket.recv(MSG_TYPE_SIZE + CHUNK_SIZE).decode()
-            if not data:
-                break
-            print(f"Received message: {data}")
-
-            req_type = data[:MSG_TYPE_SIZE-1]
-            match req_type:
-
-                case "CSQ_GETAF":
-                    msg = f"CSS_GETAF {get_files()}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case "CSQ_GETFI":
-                    file_name = data[MSG_TYPE_SIZE:]
-                    msg = f"CSS_GETFI {' '.join(files.get(file_name, ''))}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case "CSQ_GETCK":
-                    chunk_hash = data[MSG_TYPE_SIZE:]
-                    msg = f"CSS_GETCK {' '.join(chunks.get(chunk_hash, ''))}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case "CSQ_REGFI":
-                    data = data[MSG_TYPE_SIZE:].split()
-                    file_name = data[0]
-                    file_chunks = data[1:]
-                    files[file_name] = file_chunks
-                    for chunk_hash in file_chunks:
-                        chunks[chunk_hash] = set()
-                    msg = f"CSS_REGFI {len(file_chunks)}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case "CSQ_REGCK":
-                    count = 0
-                    data = data[MSG_TYPE_SIZE:].split()
-                    peer = data[0]
-                    chunk_hashes = data[1:]
-                    for chunk in chunk_hashes:
-                        if chunk in chunks:
-                            chunks[chunk].add(peer)
-                            count += 1
-                    msg = f"CSS_REGCK {count}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case "CSQ_URGPR":
-                    peers = data[MSG_TYPE_SIZE:].split()
-                    for peer in peers:
-                        for chunk, chunk_peers in chunks.items():
-                            if peer in chunk_peers:
-                                chunk_peers.remove(peer)
-                    msg = "CSS_URGPR"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-                        
-                case "CSQ_URGCK":
-                    count = 0
-                    data = data[MSG_TYPE_SIZE:].split()
-                    peer = data[0]
-                    chunk_hashes = data[1:]
-                    for chunk in chunk_hashes:
-                        if chunk in chunks:
-                            if peer in chunks[chunk]:
-                                chunks[chunk].remove(peer)
-                                count += 1
-                    msg = f"CSS_URGCK {count}"
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-                case _:
-                    msg = f"CSS_ERROR Unknown request type '{req_type}'."
-                    client_socket.sendall(msg.encode())
-                    print(f"Message sent: {msg}")
-
-            print(f"Connection closed with {client_addr}")
-        except KeyboardInterrupt:
-            print("\nClosing...")
-            break
-        except Exception as e:
-            print(f"Error accepting connection: {e}")
-            break
-        finally:
-            client_socket.close()
-    s.close()
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print("\nClosing...")